@@ -2,30 +2,150 @@
 See https://novaexchange.com/remote/faq/
 '''
 
+import copy
 import time
+from decimal import ROUND_DOWN, Decimal, InvalidOperation
 import hmac
 import hashlib
-import base64
+import binascii
+from urllib.parse import urlencode
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# imported on first use by AsyncNovaExchange, so sync-only scripts don't pay for them
+asyncio = aiohttp = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 public_set = {"markets", "market/info", "market/orderhistory", "market/openorders"}  # optional
 private_set = {"getbalances", "getbalance", "getdeposits", "getwithdrawals", "getnewdepositaddress", "getdepositaddress", "myopenorders",
                "myopenorders_market", "cancelorder", "withdraw", "trade", "tradehistory", "getdeposithistory", "getwithdrawalhistory", "walletstatus"}
 
+_TRADETYPES = frozenset(('BUY', 'SELL'))
+_TRADEBASES = frozenset((0, 1))
+_ORDERTYPES = frozenset(('BUY', 'SELL', 'BOTH'))
+# private methods after which cached balances are stale
+_BALANCE_CHANGING = frozenset(('trade', 'withdraw', 'cancelorder'))
+_AMOUNT_STEP = Decimal('0.00000001')
+
+
+def _format_amount(name, value):
+    # NovaExchange amounts have 8 decimals; truncate so we never send more than asked
+    try:
+        if isinstance(value, Decimal):
+            amount = value
+        elif isinstance(value, float):
+            amount = Decimal(repr(value))
+        else:
+            amount = Decimal(value)
+    except (TypeError, ValueError, InvalidOperation):
+        raise ValueError(name + ' ' + str(value) + ' is not a number')
+    if not amount.is_finite():
+        raise ValueError(name + ' ' + str(value) + ' must be a positive number')
+    amount = amount.quantize(_AMOUNT_STEP, rounding=ROUND_DOWN)
+    if amount <= 0:
+        raise ValueError(name + ' ' + str(value) + ' must be a positive number of at least 0.00000001')
+    return f"{amount:.8f}"
+
+
+def _ensure_async():
+    global asyncio, aiohttp
+    if aiohttp is None:
+        try:
+            import aiohttp as _aiohttp
+        except ImportError:
+            raise ImportError('AsyncNovaExchange requires aiohttp')
+        import asyncio as _asyncio
+        asyncio, aiohttp = _asyncio, _aiohttp
+
 
 class NovaExchange(object):
     """
     Used for requesting NovaExchange with API key and API secret
     """
 
+    _BASE = "https://novaexchange.com/remote/v2/"
+    _POST_HEADERS = {'content-type': 'application/x-www-form-urlencoded'}
+    # maps the first path component of a method to its request handler
+    _DISPATCH = dict({m.partition('/')[0]: '_get' for m in public_set},
+                     **{m: '_post' for m in private_set})
+
     def __init__(self, api_key=None, api_secret=None):
         self.api_key = str(api_key) if api_key is not None else ''
         self.api_secret = str(api_secret) if api_secret is not None else ''
+        # keyed once here so each signature only hashes the url
+        self._hmac_template = hmac.new(self.api_secret.encode('utf-8'), digestmod=hashlib.sha512)
+        self._session = self._new_session()
+        self._cache = {}
+        self._public_ttl = 1.0
+        self._balances_cache = {}
+        self._balances_ts = 0.0
+        self._balances_envelope = {}
+        self._balance_ttl = 1.0
+        self._addr_cache = {}
+        self._last_nonce = 0
+
+    def _new_session(self):
+        session = requests.Session()
+        session.headers.update(self._POST_HEADERS)
+        # retries reuse the pool; only GETs, as private POSTs such as trades aren't idempotent
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=('GET',), raise_on_status=False)
+        session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+        return session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the HTTP session and its pooled connections to NovaExchange
+        """
+        self._session.close()
 
-    def api_query(self, method, req=None):
+    def configure_cache(self, ttl=None, balance_ttl=None):
         """
-        Queries NovaExchange with given method and options
+        Sets how long public market responses and balances are reused
+        before querying NovaExchange again. With a ttl of 0 every call
+        goes to NovaExchange; public responses that sent an ETag or
+        Last-Modified header are then revalidated rather than re-downloaded.
+
+        :param ttl: Seconds a cached public response stays valid
+        :type ttl: float
+
+        :param balance_ttl: Seconds cached balances used by get_balance stay valid
+        :type balance_ttl: float
+
+        Either ttl left as None keeps its current value (1 second by default).
+        """
+        if ttl is not None:
+            self._public_ttl = float(ttl)
+        if balance_ttl is not None:
+            self._balance_ttl = float(balance_ttl)
+        self.cache_clear()
+
+    def cache_clear(self):
+        """
+        Drops all cached public market responses, balances and deposit addresses
+        """
+        self._cache.clear()
+        self._balances_cache = {}
+        self._balances_ts = 0.0
+        self._addr_cache.clear()
+
+    def api_query(self, method, req=None, raw=False):
+        """
+        Queries NovaExchange with given method and options.
+        The methods below call _get/_post directly; this picks
+        the right one for arbitrary method paths.
 
         :param method: Query method for getting info
         :type method: str
@@ -33,22 +153,100 @@ class NovaExchange(object):
         :req options: Extra options for query
         :type options: dict
 
+        :param raw: Return the undecoded response text instead of a dict
+        :type raw: bool
+
         :return: JSON response from NovaExchange
         :rtype : dict
         """
-        url = "https://novaexchange.com/remote/v2/"
-        if not req:
-            req = {}
-        if method.split('/')[0][0:6] == 'market':
-            r = requests.get(url + method + '/', timeout=60)
-        elif method.split('/')[0] in private_set:
-            url += 'private/' + method + '/' + '?nonce=' + str(int(time.time()))
-            req["apikey"] = self.api_key
-            req["signature"] = base64.b64encode(
-                hmac.new(self.api_secret.encode('utf-8'), msg=url.encode('utf-8'), digestmod=hashlib.sha512).digest())
-            headers = {'content-type': 'application/x-www-form-urlencoded'}
-            r = requests.post(url, data=req, headers=headers, timeout=60)
-        return(r.text)
+        handler = self._DISPATCH.get(method.partition('/')[0])
+        if handler is None:
+            raise ValueError(str(method) + ' is not a valid NovaExchange method')
+        return getattr(self, handler)(method, req or {}, raw)
+
+    def _get(self, method, req=None, raw=False):
+        # req is unused since public endpoints take no options;
+        # only public data is cached, private calls are nonce-signed
+        cached = self._cache.get(method)
+        headers = None
+        if cached is not None:
+            if time.time() - cached[0] < self._public_ttl:
+                return self._decode(cached[1], raw)
+            headers = self._revalidation_headers(cached)
+        r = self._session.get(f"{self._BASE}{method}/", headers=headers, timeout=60)
+        if r.status_code == 304 and cached is not None:
+            self._cache[method] = (time.time(),) + cached[1:]
+            return self._decode(cached[1], raw)
+        if r.ok:
+            self._cache[method] = (time.time(), r.content, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return self._decode(r.content, raw)
+
+    @staticmethod
+    def _revalidation_headers(cached):
+        # a stale entry is revalidated so an unchanged response comes back as an empty 304
+        headers = {}
+        if cached[2]:
+            headers['If-None-Match'] = cached[2]
+        if cached[3]:
+            headers['If-Modified-Since'] = cached[3]
+        return headers or None
+
+    def _post(self, method, req=None, raw=False):
+        url, body = self._private_request(method, req or {})
+        r = self._session.post(url, data=body, timeout=60)
+        self._after_private(method)
+        return self._decode(r.content, raw)
+
+    def _private_request(self, method, req):
+        url = f"{self._BASE}private/{method}/?nonce={self._nonce()}"
+        req["apikey"] = self.api_key
+        req["signature"] = self._sign(url.encode('utf-8'))
+        return url, urlencode(req).encode('ascii')
+
+    def _after_private(self, method):
+        if method.partition('/')[0] in _BALANCE_CHANGING:
+            self._balances_ts = 0.0
+
+    def _balances_fresh(self):
+        return time.time() - self._balances_ts < self._balance_ttl
+
+    def _store_balances(self, balances):
+        # returns None once stored, or the failed response so callers never see stale rows
+        if balances.get('status') != 'success':
+            self._balances_cache = {}
+            self._balances_envelope = {}
+            self._balances_ts = 0.0
+            return balances
+        self._balances_cache = {row['currency']: row for row in balances['balances']}
+        # keeps the envelope of the response so get_balance answers in the same shape
+        self._balances_envelope = {k: v for k, v in balances.items() if k != 'balances'}
+        self._balances_ts = time.time()
+        return None
+
+    def _cached_balance(self, currency):
+        row = self._balances_cache.get(currency)
+        if row is None:
+            return None
+        # deep copies, so callers editing a result can't change the cache
+        return copy.deepcopy(dict(self._balances_envelope, balances=[row]))
+
+    def _nonce(self):
+        # strictly increasing, so calls within the same second are not rejected as duplicates
+        nonce = max(time.time_ns(), self._last_nonce + 1)
+        self._last_nonce = nonce
+        return str(nonce)
+
+    def _sign(self, msg):
+        # the template and b2a_base64 are thin wrappers over OpenSSL's HMAC and a C encoder
+        signer = self._hmac_template.copy()
+        signer.update(msg)
+        return binascii.b2a_base64(signer.digest(), newline=False)
+
+    @staticmethod
+    def _decode(content, raw=False):
+        if raw:
+            return content.decode('utf-8')
+        return json_loads(content)
 
     '''
     PUBLIC METHODS  (no API key needed)
@@ -62,7 +260,7 @@ class NovaExchange(object):
         :return: Info for all markets in JSON
         :rtype : dict
         """
-        return self.api_query('markets')
+        return self._get('markets')
 
     def market_info(self, market):
         """
@@ -78,7 +276,7 @@ class NovaExchange(object):
         :return: Info for single market in JSON
         :rtype : dict
         """
-        return self.api_query('market/info/' + str(market))
+        return self._get('market/info/' + str(market))
 
     def market_order_history(self, market):
         """
@@ -94,7 +292,7 @@ class NovaExchange(object):
         :return: Info for single market order history in JSON
         :rtype : dict
         """
-        return self.api_query('market/orderhistory/' + str(market))
+        return self._get('market/orderhistory/' + str(market))
 
     def market_open_orders(self, market, ordertype):
         """
@@ -111,12 +309,13 @@ class NovaExchange(object):
 
         :return: Info for single market public open orders in JSON
         :rtype : dict
+
+        :raises ValueError: if ordertype is not BUY, SELL or BOTH
         """
-        order_options = ['BUY', 'SELL', 'BOTH']
-        if str(ordertype) in order_options:
-            return self.api_query(('market/openorders/' + str(market) + '/' + str(ordertype)))
-        else:
-            return(ordertype, 'is not a valid ordertype. please use BUY, SELL, or BOTH.')
+        ordertype = str(ordertype)
+        if ordertype not in _ORDERTYPES:
+            raise ValueError(ordertype + ' is not a valid ordertype. please use BUY, SELL, or BOTH.')
+        return self._get(('market/openorders/' + str(market) + '/' + ordertype))
 
     '''
     PRIVATE METHODS  (must have permissions enabled w/ api key and secret)
@@ -129,7 +328,7 @@ class NovaExchange(object):
         :return: Info for balances in account in JSON
         :rtype : dict
         """
-        return self.api_query('getbalances')
+        return self._post('getbalances')
 
     def get_balance(self, currency):
         """
@@ -141,10 +340,22 @@ class NovaExchange(object):
         example
         "currency": "BTC"
 
+        Served from the result of get_balances(), which is refreshed
+        at most once per balance_ttl (see configure_cache). If that
+        refresh fails, its error response is returned.
+
         :return: Info for specific currency balance in JSON
         :rtype : dict
         """
-        return self.api_query('getbalance/' + str(currency))
+        currency = str(currency)
+        if not self._balances_fresh():
+            error = self._store_balances(self.get_balances())
+            if error is not None:
+                return error
+        balance = self._cached_balance(currency)
+        if balance is None:
+            return self._post('getbalance/' + currency)
+        return balance
 
     def get_deposits(self):
         """
@@ -153,7 +364,7 @@ class NovaExchange(object):
         :return: Info on incoming deposits in JSON
         :rtype : dict
         """
-        return self.api_query('getdeposits')
+        return self._post('getdeposits')
 
     # not working? even with all api permissions turned on
     def get_withdrawals(self):
@@ -163,7 +374,7 @@ class NovaExchange(object):
         :return: Info on outgoing withdrawals in JSON
         :rtype : dict
         """
-        return self.api_query('getwithdrawals')
+        return self._post('getwithdrawals')
 
     def get_new_deposit_address(self, currency):
         """
@@ -178,7 +389,8 @@ class NovaExchange(object):
         :return: Info on new deposit address in JSON
         :rtype : dict
         """
-        return self.api_query('getnewdepositaddress/' + str(currency))
+        self._addr_cache.pop(str(currency), None)
+        return self._post('getnewdepositaddress/' + str(currency))
 
     def get_deposit_address(self, currency):
         """
@@ -190,10 +402,20 @@ class NovaExchange(object):
         example
         "currency": "BTC"
 
+        Addresses are cached until get_new_deposit_address
+        is called for the currency.
+
         :return: Info on specific currency depsoit address in JSON
         :rtype : dict
         """
-        return self.api_query('getdepositaddress/' + str(currency))
+        currency = str(currency)
+        address = self._addr_cache.get(currency)
+        if address is None:
+            address = self._post('getdepositaddress/' + currency)
+            if address.get('status') == 'success':
+                self._addr_cache[currency] = copy.deepcopy(address)
+            return address
+        return copy.deepcopy(address)
 
     def my_open_orders(self):
         """
@@ -202,7 +424,7 @@ class NovaExchange(object):
         :return: Info on open orders in JSON
         :rtype : dict
         """
-        return self.api_query('myopenorders')
+        return self._post('myopenorders')
 
     def my_open_orders_market(self, market):
         """
@@ -218,7 +440,7 @@ class NovaExchange(object):
         :return: Info on a specific market's open orders in JSON
         :rtype : dict
         """
-        return self.api_query('myopenorders_market/' + str(market))
+        return self._post('myopenorders_market/' + str(market))
 
     def cancel_order(self, order_id):
         """
@@ -233,7 +455,7 @@ class NovaExchange(object):
         :return: Info on the order that is being cancelled in JSON
         :rtype : dict
         """
-        return self.api_query('cancelorder/' + str(order_id))
+        return self._post('cancelorder/' + str(order_id))
 
     def withdraw(self, currency, amount, address):
         """
@@ -249,10 +471,15 @@ class NovaExchange(object):
         "amount": 1000.12345678
         "address": KF2yLFLcZwYigRDw5Uo9U4B9hEaLqwkVxL
 
+        amount is truncated to 8 decimals, never rounded up.
+
         :return: Info on the withdrawal in JSON
         :rtype : dict
+
+        :raises ValueError: if amount is not a number or is below 0.00000001
         """
-        return self.api_query(('withdraw/' + str(currency)), req={"currency": str(currency), "amount": float(amount), "address": str(address)})
+        amount = _format_amount('amount', amount)
+        return self._post(('withdraw/' + str(currency)), req={"currency": str(currency), "amount": amount, "address": str(address)})
 
     def trade(self, market, tradetype, tradeamount, tradeprice, tradebase=0):
         """
@@ -272,27 +499,28 @@ class NovaExchange(object):
         "tradeprice": 0.00006
         "tradebase": 0
 
+        tradeamount and tradeprice are truncated to 8 decimals, never rounded up.
+
         :return: Info on the trade in JSON
         :rtype : dict
+
+        :raises ValueError: if tradetype or tradebase is invalid, or if
+            tradeamount or tradeprice is not a number or is below 0.00000001
         """
         tradetype = str(tradetype)
         tradebase = int(tradebase)
-        tradeamount = float(tradeamount)
-        tradeprice = float(tradeprice)
-        if (tradetype == 'BUY' or tradetype == 'SELL'):
-            pass
-        else:
-            return('trade type', str(tradetype), 'is invalid. (Set as  BUY or SELL)')
-        if (tradebase == 0 or tradebase == 1):
-            pass
-        else:
-            return('tradebase', str(tradebase), 'is invalid (Set as 0 for market currency or 1 for basecurrency as tradeamount)')
+        tradeamount = _format_amount('tradeamount', tradeamount)
+        tradeprice = _format_amount('tradeprice', tradeprice)
+        if tradetype not in _TRADETYPES:
+            raise ValueError('trade type ' + tradetype + ' is invalid. (Set as BUY or SELL)')
+        if tradebase not in _TRADEBASES:
+            raise ValueError('tradebase ' + str(tradebase) + ' is invalid (Set as 0 for market currency or 1 for basecurrency as tradeamount)')
 
-        return self.api_query(('trade/' + str(market)), req={'tradetype': tradetype, 'tradebase': tradebase, 'tradeprice': tradeprice, 'tradeamount': tradeamount})
+        return self._post(('trade/' + str(market)), req={'tradetype': tradetype, 'tradebase': str(tradebase), 'tradeprice': tradeprice, 'tradeamount': tradeamount})
 
     # additional page param not working?
     # def trade_history(self, page=1):
-        # return self.api_query('tradehistory', req={'page': int(page)})
+        # return self._post('tradehistory', req={'page': int(page)})
 
     def trade_history(self):
         """
@@ -301,7 +529,7 @@ class NovaExchange(object):
         :return: Info on your trade history in JSON
         :rtype : dict
         """
-        return self.api_query('tradehistory')
+        return self._post('tradehistory')
 
     def get_deposit_history(self):
         """
@@ -310,7 +538,7 @@ class NovaExchange(object):
         :return: Info on deposit history in JSON
         :rtype : dict
         """
-        return self.api_query('getdeposithistory')
+        return self._post('getdeposithistory')
 
     def get_withdrawal_history(self):
         """
@@ -319,7 +547,7 @@ class NovaExchange(object):
         :return: Info on withdrawal history in JSON
         :rtype : dict
         """
-        return self.api_query('getwithdrawalhistory')
+        return self._post('getwithdrawalhistory')
 
     def wallet_status(self, currency=None):
         """
@@ -337,6 +565,121 @@ class NovaExchange(object):
         :rtype : dict
         """
         if currency == None:
-            return self.api_query('walletstatus')
+            return self._post('walletstatus')
         else:
-            return self.api_query('walletstatus/' + str(currency))
+            return self._post('walletstatus/' + str(currency))
+
+
+class AsyncNovaExchange(NovaExchange):
+    """
+    Used for requesting NovaExchange concurrently from asyncio code.
+
+    Every method of NovaExchange is available and must be awaited,
+    e.g. ``await nx.market_info('LTC_MEOW')``. Requires aiohttp.
+    """
+
+    def __init__(self, api_key=None, api_secret=None):
+        _ensure_async()
+        super(AsyncNovaExchange, self).__init__(api_key, api_secret)
+        self._balances_refresh = None
+
+    def _new_session(self):
+        # aiohttp sessions must be created inside a running event loop
+        return None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+                headers=self._POST_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=60))
+        return self._session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __enter__(self):
+        raise TypeError('use "async with" with AsyncNovaExchange')
+
+    async def close(self):
+        """
+        Closes the HTTP session and its pooled connections to NovaExchange
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get(self, method, req=None, raw=False):
+        cached = self._cache.get(method)
+        headers = None
+        if cached is not None:
+            if time.time() - cached[0] < self._public_ttl:
+                return self._decode(cached[1], raw)
+            headers = self._revalidation_headers(cached)
+        async with self._get_session().get(f"{self._BASE}{method}/", headers=headers) as r:
+            if r.status == 304 and cached is not None:
+                self._cache[method] = (time.time(),) + cached[1:]
+                return self._decode(cached[1], raw)
+            content = await r.read()
+            if r.status < 400:
+                self._cache[method] = (time.time(), content, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return self._decode(content, raw)
+
+    async def _post(self, method, req=None, raw=False):
+        url, body = self._private_request(method, req or {})
+        async with self._get_session().post(url, data=body) as r:
+            content = await r.read()
+        self._after_private(method)
+        return self._decode(content, raw)
+
+    async def get_balance(self, currency):
+        """
+        Awaitable NovaExchange.get_balance, sharing its balances cache
+        """
+        currency = str(currency)
+        if not self._balances_fresh():
+            # concurrent lookups share one in-flight getbalances request
+            if self._balances_refresh is None:
+                self._balances_refresh = asyncio.ensure_future(self._refresh_balances())
+            error = await asyncio.shield(self._balances_refresh)
+            if error is not None:
+                return error
+        balance = self._cached_balance(currency)
+        if balance is None:
+            return await self._post('getbalance/' + currency)
+        return balance
+
+    async def _refresh_balances(self):
+        try:
+            return self._store_balances(await self.get_balances())
+        finally:
+            self._balances_refresh = None
+
+    async def get_deposit_address(self, currency):
+        """
+        Awaitable NovaExchange.get_deposit_address, sharing its address cache
+        """
+        currency = str(currency)
+        address = self._addr_cache.get(currency)
+        if address is None:
+            address = await self._post('getdepositaddress/' + currency)
+            if address.get('status') == 'success':
+                self._addr_cache[currency] = copy.deepcopy(address)
+            return address
+        return copy.deepcopy(address)
+
+    async def gather_market_info(self, markets):
+        """
+        Used to retrieve the public market summaries for several
+        markets at once, with the requests running concurrently.
+
+        example:
+        "markets": ["LTC_MEOW", "BTC_ONION"]
+
+        :return: Info for each market in JSON, in the given order
+        :rtype : list
+        """
+        return await asyncio.gather(*(self.market_info(market) for market in markets))